@@ -1,86 +1,161 @@
 from flask import Flask, jsonify, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
-import sqlite3, os, time
+from contextlib import contextmanager
+import sqlite3, os, time, queue, atexit, threading
 
 app = Flask(__name__)
 CORS(app)
+# Behind Apache mod_xsendfile (or nginx translating X-Sendfile) let the web server stream PDFs.
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE") == "1"
 
 BASE = os.path.dirname(__file__)                  # Currently backend/api
 ROOT = os.path.abspath(os.path.join(BASE, os.pardir, os.pardir))
-DB = os.path.join(ROOT, 'receipts.db')
+DB = os.path.join(ROOT, 'receipts.db')            # absolute already, since ROOT is
 SUCC_DIR = os.path.join(ROOT, 'success_pdfs')
 FAIL_DIR = os.path.join(ROOT, 'error_pdfs')
+POOL_SIZE = 4
+PDF_MAX_AGE = 3600                                # a receipt's PDF never changes once filed
+WATCH_INTERVAL = 0.5                              # seconds between data_version checks
+KEEPALIVE = 15                                    # seconds of silence before a comment ping
+
+_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+PRAGMA busy_timeout=5000;
+"""
+
+
+class ConnectionPool:
+    """Fixed set of long-lived connections so the page cache stays warm between requests."""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self._q = queue.Queue(maxsize=size)
+        self._all = []
+        for _ in range(size):
+            con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            con.executescript(_PRAGMAS)
+            con.row_factory = sqlite3.Row             # rows index by position *and* name
+            self._all.append(con)
+            self._q.put(con)
+
+    @contextmanager
+    def acquire(self):
+        con = self._q.get()
+        try:
+            yield con
+        finally:
+            self._q.put(con)
+
+    def close_all(self):
+        for con in self._all:
+            con.close()
+        self._all.clear()
+
+
+pool = ConnectionPool(DB)
+atexit.register(pool.close_all)
 
 
 def query_db(q, args=()):
-    con = sqlite3.connect(os.path.abspath(DB)); cur = con.cursor()
-    cur.execute(q, args); rows = cur.fetchall(); con.close()
-    return rows
-
-def table_exists(con, name: str) -> bool:
-    cur = con.cursor()
-    cur.execute(
-        "SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?",
-        (name,),
-    )
-    exists = cur.fetchone()[0] == 1
-    cur.close()
-    return exists
+    with pool.acquire() as con:
+        return con.execute(q, args).fetchall()
+
+# The schema is static once db_utils.init_schema() has run, so table names are
+# looked up once instead of on every request.
+TABLES = frozenset()
+
+def refresh_schema_cache():
+    global TABLES
+    # build the new set, then swap it in: readers never see a half-filled one
+    TABLES = frozenset(r[0] for r in query_db("SELECT name FROM sqlite_master WHERE type='table'"))
+
+refresh_schema_cache()
+
+# Writes come from controller.py (another process), so a single watcher thread
+# notices them via data_version and wakes every SSE client at once.
+_changed = threading.Condition()
+_version = 0
+
+def _watch_db():
+    global _version
+    conn = sqlite3.connect(DB, check_same_thread=False)
+    last = None                                   # baseline comes from the first good read
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        try:
+            ver = conn.execute("PRAGMA data_version").fetchone()[0]
+        except Exception:
+            # e.g. a transient lock/IO error: the thread must survive, or SSE goes silent
+            app.logger.exception("data_version check failed; retrying")
+            continue
+        if last is not None and ver != last:
+            with _changed:
+                _version += 1
+                _changed.notify_all()
+        last = ver
+
+threading.Thread(target=_watch_db, name="db-watcher", daemon=True).start()
+
+def _sse(event=None, data="", comment=None):
+    """Frame one SSE message (a comment line when *comment* is given)."""
+    if comment is not None:
+        return f": {comment}\n\n"
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in str(data).splitlines() or [""]]
+    return "\n".join(lines) + "\n\n"
 
 @app.route("/api/stream")
 def stream():
     """EventSource endpoint – emits 'update' whenever the DB changes."""
     @stream_with_context
     def event_stream():
-        conn = sqlite3.connect(os.path.abspath(DB))
-        cur  = conn.cursor()
-        cur.execute("PRAGMA data_version")
-        last_version = cur.fetchone()[0]
-
+        seen = _version
         while True:
-            time.sleep(2)                            # poll every 2 s
-            cur.execute("PRAGMA data_version")
-            ver = cur.fetchone()[0]
-            if ver != last_version:
-                last_version = ver
-                yield "event: update\ndata: {}\n\n"  # empty JSON payload
-
-            # keep‑alive every 30 s so proxies don’t close idle stream
-            if int(time.time()) % 30 == 0:
-                yield ": keep-alive\n\n"
-
-    # correct SSE MIME type
-    return Response(event_stream(), mimetype="text/event-stream")
+            with _changed:
+                changed = _changed.wait_for(lambda: _version != seen, timeout=KEEPALIVE)
+                seen = _version
+            if changed:
+                yield _sse(event="update", data="{}")  # empty JSON payload
+            else:
+                # keep‑alive so proxies don’t close idle stream
+                yield _sse(comment="keep-alive")
+
+    # correct SSE MIME type; stop caches and nginx from buffering the stream
+    return Response(
+        event_stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.route('/api/receipts')
 def list_receipts():
-    con = sqlite3.connect(DB)
     success_list = []
     failed_list = []
 
-    # check for successful_receipts table
-    if table_exists(con, "successful_receipts"):
-        rows = con.execute(
-            "SELECT generated_receipt_id, date, amount, vendor_name, category, evaluation_score "
-            "FROM successful_receipts"
-        ).fetchall()
-        success_list = [
-            {"id": r[0], "date": r[1], "amount":r[2], "vendor_name":r[3], "category":r[4], "score": r[5]}
-            for r in rows
-        ]
-
-    # check for failed_receipts table
-    if table_exists(con, "failed_receipts"):
-        rows = con.execute(
-            "SELECT generated_receipt_id, original_pdf_filename, error_message, evaluation_score "
+    # tables may have been created by the controller after we started
+    if not {"successful_receipts", "failed_receipts"} <= TABLES:
+        refresh_schema_cache()
+
+    # both tables are created together by init_schema, so one round trip covers them
+    if {"successful_receipts", "failed_receipts"} <= TABLES:
+        rows = query_db(
+            "SELECT 'S', generated_receipt_id, date, amount, vendor_name, category, evaluation_score, NULL, NULL "
+            "FROM successful_receipts "
+            "UNION ALL "
+            "SELECT 'F', generated_receipt_id, NULL, NULL, NULL, NULL, evaluation_score, original_pdf_filename, error_message "
             "FROM failed_receipts"
-        ).fetchall()
-        failed_list = [
-            {"id": r[0], "filename": r[1], "error": r[2], "score": r[3]}
-            for r in rows
-        ]
+        )
+        for r in rows:
+            if r[0] == 'S':
+                success_list.append(
+                    {"id": r[1], "date": r[2], "amount":r[3], "vendor_name":r[4], "category":r[5], "score": r[6]}
+                )
+            else:
+                failed_list.append({"id": r[1], "filename": r[7], "error": r[8], "score": r[6]})
 
-    con.close()
     return jsonify({
         "successful": success_list,
         "failed": failed_list,
@@ -88,22 +163,15 @@ def list_receipts():
 
 @app.route('/api/receipt/<rid>')
 def receipt_detail(rid):
-    row = query_db("SELECT *, generated_receipt_id FROM successful_receipts WHERE generated_receipt_id=?", (rid,))
+    row = query_db("SELECT * FROM successful_receipts WHERE generated_receipt_id=?", (rid,))
     folder = SUCC_DIR
     if not row:
-        row = query_db("SELECT *, generated_receipt_id FROM failed_receipts WHERE generated_receipt_id=?", (rid,))
+        row = query_db("SELECT * FROM failed_receipts WHERE generated_receipt_id=?", (rid,))
         folder = FAIL_DIR
     if not row:
         return jsonify({'error': 'not found'}), 404
 
-    conn = sqlite3.connect(os.path.abspath(DB))
-    cur = conn.cursor()
-    cols_info = cur.execute(
-        'PRAGMA table_info(successful_receipts)' if folder == SUCC_DIR else
-        'PRAGMA table_info(failed_receipts)'
-    ).fetchall()
-    cols = [d[1] for d in cols_info]
-    record = dict(zip(cols, row[0]))
+    record = dict(row[0])
     return jsonify({
       **record,
       'pdf_url': f'/api/receipt-file/{rid}/{ "success" if folder==SUCC_DIR else "failed"}'
@@ -112,17 +180,14 @@ def receipt_detail(rid):
 @app.route('/api/receipt-file/<rid>/<typ>')
 def receipt_file(rid, typ):
     folder = SUCC_DIR if typ=='success' else FAIL_DIR
-    return send_from_directory(folder, f"{rid}.pdf")
+    # Werkzeug hands the open file to wsgi.file_wrapper when the server offers one
+    # (gunicorn → sendfile(2)); conditional requests get 304s via ETag/Last-Modified.
+    return send_from_directory(folder, f"{rid}.pdf", conditional=True, max_age=PDF_MAX_AGE)
 
 
 @app.route('/api/debug')
 def debug_db():
-    import sqlite3, os
     # DB = os.path.join(os.path.dirname(__file__), '../receipts.db')
     exists = os.path.isfile(DB)
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tables = [r[0] for r in cur.fetchall()]
-    conn.close()
+    tables = [r[0] for r in query_db("SELECT name FROM sqlite_master WHERE type='table'")]
     return jsonify({"db_path": DB, "exists": exists, "tables": tables})
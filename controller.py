@@ -1,5 +1,5 @@
 from langgraph.graph import StateGraph, END
-from typing import TypedDict, Annotated, Callable, Any
+from typing import TypedDict, Callable, Any
 try:
     from typing import NotRequired  # Python 3.11+
 except ImportError:
@@ -7,26 +7,34 @@ except ImportError:
 from dotenv import load_dotenv
 import google.generativeai as genai
 import os
-import json
+import orjson
 import re
 import time
 import sqlite3
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
 import shutil
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from tools import (
-    extract_and_crop_receipt_images,
-    extract_data_from_images,
+    render_receipt_pages,
+    extract_receipt_data,
     evaluate_extracted_data_with_llm,
-    manage_processed_receipt_files
+    manage_processed_receipt_files,
+    forget_cached_extraction,
 )
-from db_utils import receipt_exists, insert_failed_receipt, insert_success_receipt
-from tools import _robust_move
+from db_utils import receipt_exists, insert_failed_receipt, insert_success_receipt, optimize
+from tools import _robust_move, _schedule_dir_fsync, start_queue_logging, LOG_FORMAT
 import logging
 
-logging.basicConfig(filename="info.log", level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s') 
+# Workers only enqueue log records; a listener thread does the file/console IO.
+_file_handler = logging.FileHandler("info.log", encoding="utf-8")
+_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(logging.Formatter('%(message)s'))
+start_queue_logging(_file_handler, _console_handler)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
@@ -38,24 +46,46 @@ if GOOGLE_API_KEY:
 DRIVE_PROJECT_FOLDER = os.path.dirname(os.path.abspath(__file__)) 
 input_pdf_folder = os.path.join(DRIVE_PROJECT_FOLDER, "pdfs")
 success_pdf_folder = os.path.join(DRIVE_PROJECT_FOLDER, "success_pdfs")
-cropped_images_folder = os.path.join(DRIVE_PROJECT_FOLDER, "images")
 error_pdf_folder = os.path.join(DRIVE_PROJECT_FOLDER, "error_pdfs")
 
 
 RECEIPT_DATABASE_PATH = os.path.join(DRIVE_PROJECT_FOLDER, "receipts.db")
+DB_OPTIMIZE_INTERVAL = 15 * 60  # seconds between planner‑statistics refreshes (db_utils.optimize)
+# A receipt passes when its evaluation score is above this. Only self‑scores that
+# already pass skip the second opinion from evaluate_extracted_data_with_llm.
+PASS_SCORE = 75
 
-for _d in (input_pdf_folder, success_pdf_folder, error_pdf_folder, cropped_images_folder):
+# PDFs are processed concurrently; the stages inside each one are bounded separately.
+GEMINI_CONCURRENCY = 8  # Gemini requests in flight at once
+# Gemini calls are I/O‑bound, so there are enough workers to keep all of them busy.
+PIPELINE_WORKERS = max(os.cpu_count() or 1, GEMINI_CONCURRENCY)
+# (rendering is bounded inside tools: one in‑process render at a time, plus the render pool)
+_gemini_sem = threading.BoundedSemaphore(GEMINI_CONCURRENCY)
+
+for _d in (input_pdf_folder, success_pdf_folder, error_pdf_folder):
     os.makedirs(_d, exist_ok=True)
 
-def stable_file(path: str, checks: int = 3, delay: float = 0.3) -> None:
-    """Wait until a file reaches a stable size (handles partially‑written PDFs)."""
-    last = -1
+# Moves are only a cheap atomic rename when source and destination share a filesystem.
+if len({os.stat(_d).st_dev for _d in (input_pdf_folder, success_pdf_folder, error_pdf_folder)}) > 1:
+    logger.warning("pdfs/, success_pdfs/ and error_pdfs/ are on different filesystems; "
+                   "moves will fall back to copy + delete")
+
+def stable_file(path: str, checks: int = 5, delay: float = 0.05) -> None:
+    """Wait until a file's size and mtime stop changing (handles partially‑written PDFs).
+    The wait doubles after every change, so a finished file costs one short sleep.
+    An empty file is never taken as stable: right after IN_CREATE the writer may
+    not have written anything yet."""
+    st = os.stat(path)
+    last = (st.st_size, st.st_mtime_ns)
     for _ in range(checks):
-        size = os.path.getsize(path)
-        if size == last:
-            return
-        last = size
         time.sleep(delay)
+        st = os.stat(path)
+        current = (st.st_size, st.st_mtime_ns)
+        if current == last and st.st_size > 0:
+            return
+        last = current
+        delay *= 2
+
 
 
 def safe_replace(src: str, dst: str) -> None:
@@ -64,6 +94,7 @@ def safe_replace(src: str, dst: str) -> None:
         os.replace(src, dst)  # atomic on Win & POSIX (overwrites)
     except Exception:
         shutil.move(src, dst)
+    _schedule_dir_fsync(src, dst)
 
 class GraphState(TypedDict):
     """
@@ -71,7 +102,7 @@ class GraphState(TypedDict):
     Values are "patches" (updates to the state).
     """
     pdf_path: str
-    image_paths: Annotated[list[str], "append"] # Use append to collect multiple paths
+    page_images: NotRequired[list[Any]]  # cropped pages as JPEG parts, kept in memory between nodes
     extracted_json_str: NotRequired[str]
     evaluated_data: NotRequired[str]
     db_process_status: NotRequired[str]
@@ -80,49 +111,66 @@ class GraphState(TypedDict):
 
 def call_extract_images(state: GraphState) -> GraphState:
     """Node to extract and crop images from the PDF."""
-    print("\n--- Node: call_extract_images ---")
+    logger.debug("--- Node: call_extract_images ---")
     pdf_path = state["pdf_path"]
     try:
-        result = extract_and_crop_receipt_images.invoke({
-            "pdf_path": pdf_path,
-            "cropped_images_folder": cropped_images_folder
-        })
-        if result.startswith("ERROR:"):
-            return {"processed_status": "FAILED", "error_message": result} # type: ignore
-        image_paths = list(json.loads(result).values())[0]
+        page_images = render_receipt_pages(pdf_path, jpeg=True)
+        if not page_images:
+            return {"processed_status": "FAILED", "error_message": f"ERROR: No images were extracted from {pdf_path}. It might be empty or corrupted."} # type: ignore
         return {
-                "image_paths": image_paths,
+                "page_images": page_images,
                 "processed_status": "SUCCESS"
             } # type: ignore
     except Exception as e:
         return {"processed_status": "FAILED", "error_message": f"Extract images failed: {e}"} # type: ignore
     
+def _split_self_evaluation(result: str) -> tuple[str, str | None]:
+    """Separate the model's self‑assessment from the extracted fields.
+    Returns (extracted JSON, evaluation JSON) – the latter only when the score
+    is a valid integer that already passes (above PASS_SCORE)."""
+    data = orjson.loads(result)
+    score = data.pop("evaluation_score", None)
+    feedback = data.pop("feedback", None)
+    extracted = orjson.dumps(data).decode()
+    if isinstance(score, int) and not isinstance(score, bool) and PASS_SCORE < score <= 100 and isinstance(feedback, str):
+        return extracted, orjson.dumps({"evaluation_score": score, "feedback": feedback}).decode()
+    return extracted, None
+
 def call_extract_data(state: GraphState) -> GraphState:
-    """Node to extract structured data from images using Gemini."""
-    print("\n--- Node: call_extract_data ---")
+    """Node to extract structured data (plus a self‑evaluation) from images using Gemini."""
+    logger.debug("--- Node: call_extract_data ---")
     if state.get("processed_status") != "SUCCESS":
         return {"processed_status": "FAILED", "error_message": f"Extract data failed because of corrupted data"} # type: ignore
     try:
-        result = extract_data_from_images.invoke({
-            "image_paths_json_str": json.dumps(state["image_paths"])
-        })
+        with _gemini_sem:
+            result = extract_receipt_data(state["page_images"]) # type: ignore
         if result.startswith("ERROR:"):
             return {"processed_status": "FAILED", "error_message": result} # type: ignore
-        return {"extracted_json_str": result, "processed_status": "SUCCESS"} # type: ignore
+        extracted, evaluation = _split_self_evaluation(result)
+        if evaluation is None:
+            return {"extracted_json_str": extracted, "processed_status": "SUCCESS"} # type: ignore
+        return {"extracted_json_str": extracted, "evaluated_data": evaluation, "processed_status": "SUCCESS"} # type: ignore
     except Exception as e:
         return {"processed_status": "FAILED", "error_message": f"Extract data failed: {e}"} # type: ignore
     
 
+def route_after_extract(state: GraphState) -> str:
+    """Only receipts without a confident self‑evaluation get a second LLM pass."""
+    if state.get("processed_status") == "SUCCESS" and not state.get("evaluated_data"):
+        return "evaluate_data"
+    return "finalize"
+
 def call_evaluate_data(state: GraphState) -> GraphState:
-    """Node to evaluate the extracted data using another LLM."""
+    """Node to evaluate the extracted data using another LLM (second pass for low‑confidence results)."""
     if state.get("processed_status") != "SUCCESS":
         return {"processed_status": "FAILED", "error_message": f"Evaluating data failed because of corrupted data"} # type: ignore
     
     try:
-        result = evaluate_extracted_data_with_llm.invoke({  # noqa: F821
-            "extracted_json_str": state["extracted_json_str"], # type: ignore
-            "original_pdf_path": state["pdf_path"],
-        })
+        with _gemini_sem:
+            result = evaluate_extracted_data_with_llm.invoke({  # noqa: F821
+                "extracted_json_str": state["extracted_json_str"], # type: ignore
+                "original_pdf_path": state["pdf_path"],
+            })
         if result.startswith("ERROR:"):
             return {"processed_status": "FAILED", "error_message": result} # type: ignore
         return {"evaluated_data": result, "processed_status": "SUCCESS"} # type: ignore
@@ -130,37 +178,46 @@ def call_evaluate_data(state: GraphState) -> GraphState:
         return {"processed_status": "FAILED", "error_message": f"LLM evaluation failed: {e}"} # type: ignore
     
 
+def _forget_extraction(state: GraphState) -> None:
+    """A receipt that fails must not be answered from the cache when it is retried."""
+    if state.get("page_images"):
+        forget_cached_extraction(state["page_images"]) # type: ignore
+
 def call_finalize(state: GraphState) -> GraphState:
     """Node to manage processed files."""
-    print("\n--- Node: call_process_files ---")
+    logger.debug("--- Node: call_process_files ---")
     if state.get("processed_status") != "SUCCESS":
+        _forget_extraction(state)
         return {"processed_status": "FAILED", "error_message": f"Finalize failed because of corrupted data"} # type: ignore
     try:
-        evaluation = json.loads(state["evaluated_data"]) # type: ignore
+        evaluation = orjson.loads(state["evaluated_data"]) # type: ignore
+        extracted = orjson.loads(state["extracted_json_str"]) # type: ignore
         score = evaluation["evaluation_score"]
         feedback = evaluation["feedback"]
         # pdf_path = state["pdf_path"]
         pdf_filename = os.path.basename(state["pdf_path"])
-        print(f"Pdf Filename: {pdf_filename},  Evaluation score: {score}, feedback: {feedback}")
-        if score > 75:
-            new_id = insert_success_receipt(pdf_filename, json.loads(state["extracted_json_str"]), feedback, score)
+        logger.info(f"Pdf Filename: {pdf_filename},  Evaluation score: {score}, feedback: {feedback}")
+        if score > PASS_SCORE:
+            new_id = insert_success_receipt(pdf_filename, extracted, feedback, score)
             validation_success = True
         else:
             error_msg = "評価スコアが低いため、処理に失敗しました。"
-            new_id = insert_failed_receipt(pdf_filename, error_msg, json.loads(state["extracted_json_str"]),feedback, score)
+            new_id = insert_failed_receipt(pdf_filename, error_msg, extracted, feedback, score)
             validation_success = False
+            _forget_extraction(state)
         result = manage_processed_receipt_files.invoke({  # noqa: F821
             "original_pdf_path": state["pdf_path"],
-            "cropped_images_folder": cropped_images_folder,
             "success_pdf_folder": success_pdf_folder,
             "error_pdf_folder": error_pdf_folder,
             "validation_success": validation_success,
             "new_file_name": new_id,
         })
         if result.startswith("ERROR:"):
+            _forget_extraction(state)
             return {"processed_status": "FAILED", "error_message": result} # type: ignore
         return {"processed_status": "SUCCESS"} # type: ignore
     except Exception as e:
+        _forget_extraction(state)
         return {"processed_status": "FAILED", "error_message": f"File management failed: {e}"} # type: ignore
     
 workflow = StateGraph(GraphState)
@@ -172,7 +229,7 @@ workflow.set_entry_point("extract_images")
 
 # Success path edges
 workflow.add_edge("extract_images", "extract_data")
-workflow.add_edge("extract_data", "evaluate_data")
+workflow.add_conditional_edges("extract_data", route_after_extract, ["evaluate_data", "finalize"])
 workflow.add_edge("evaluate_data", "finalize")
 workflow.add_edge("finalize", END)
 app = workflow.compile()
@@ -180,46 +237,42 @@ app = workflow.compile()
 
 def process_pdf(pdf_path: str):
     # Put your existing pipeline invocation here
-    print(f"🛠️  Start processing {pdf_path}")
+    logger.info(f"🛠️  Start processing {pdf_path}")
     pdf_filename = os.path.basename(pdf_path)
     if receipt_exists(pdf_path):
-        print(f"{pdf_path} already processed — skipping")
+        logger.info(f"{pdf_path} already processed — skipping")
         insert_failed_receipt(
             pdf_filename, "同じ名前のファイルは既に処理されています", {}, None, None,
         )
         _robust_move(pdf_path, os.path.join(error_pdf_folder, pdf_filename))
         return
         
-    print(f"\n--- New PDF detected: {pdf_filename}. Starting LangGraph workflow. ---")
-
-    initial_state = GraphState(
-        pdf_path=pdf_path, # type: ignore
-        image_paths=[],
-    )
+    logger.info(f"--- New PDF detected: {pdf_filename}. Starting LangGraph workflow. ---")
 
     try:
         stable_file(pdf_path) # type: ignore
         initial_state = GraphState(
             pdf_path=pdf_path, # type: ignore
-            image_paths=[],
         )
         final_state : GraphState | None = None
         for step_state in app.stream(initial_state):
-            print(f"Current state: {step_state}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Current state: {step_state}")
             final_state = step_state # type: ignore
 
         status = final_state["finalize"]["processed_status"] # type: ignore
-        print(f"Final state: {final_state}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Final state: {final_state}")
         if status == "SUCCESS":
-            print(f"\n--- Workflow completed SUCCESSFULLY for {pdf_filename} ---")
+            logger.info(f"--- Workflow completed SUCCESSFULLY for {pdf_filename} ---")
         else:
             error_message = final_state.get("error_message", "Unknown error") if final_state else "No state captured"
-            print(f"\n--- Workflow FAILED for {pdf_filename}: {error_message} ---")
+            logger.warning(f"--- Workflow FAILED for {pdf_filename}: {error_message} ---")
             safe_replace(pdf_path, os.path.join(error_pdf_folder, pdf_filename)) # type: ignore
     except Exception as e:
-        print(f"\n--- Critical error for {pdf_filename}: {e} ---")
+        logger.error(f"--- Critical error for {pdf_filename}: {e} ---")
         safe_replace(pdf_path, os.path.join(error_pdf_folder, pdf_filename))
-    print(f"✅ Finished {pdf_path}")
+    logger.info(f"✅ Finished {pdf_path}")
 
 
 class PDFHandler(FileSystemEventHandler):
@@ -237,29 +290,52 @@ class PDFHandler(FileSystemEventHandler):
         self.executor.submit(process_pdf, event.src_path)
 
 from watchdog.events import FileCreatedEvent
+
+def start_observer(handler: FileSystemEventHandler, path: str):
+    """Start the platform's native observer (inotify / FSEvents / ReadDirectoryChangesW),
+    falling back to stat polling only if the kernel refuses another watch."""
+    observer = Observer()
+    observer.schedule(handler, path, recursive=False)
+    try:
+        observer.start()
+    except OSError as e:
+        # typically fs.inotify.max_user_watches / max_user_instances exhausted in a container
+        logger.warning(f"{type(observer).__name__} could not start ({e}); falling back to PollingObserver. "
+                       "Raise /proc/sys/fs/inotify/max_user_watches and max_user_instances to avoid this.")
+        observer = PollingObserver()
+        observer.schedule(handler, path, recursive=False)
+        observer.start()
+    logger.info(f"Watching {path} with {type(observer).__name__}")
+    return observer
+
 def monitor_and_process_pdfs(input_dir):
-    executor = ThreadPoolExecutor(max_workers=1)
+    executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS)
     handler = PDFHandler(executor)
-    observer = Observer()
-    observer.schedule(handler, input_pdf_folder, recursive=False)
-    observer.start()
+    observer = start_observer(handler, input_pdf_folder)
 
     # Submit all existing PDFs on startup
-    for fn in os.listdir(input_pdf_folder):
-        full = os.path.join(input_pdf_folder, fn)
-        if fn.lower().endswith(".pdf"):
-            handler.on_created(FileCreatedEvent(full))
-    print(f"📁 Monitoring folder: {input_dir}")
+    with os.scandir(input_pdf_folder) as it:
+        for entry in it:
+            if entry.name.lower().endswith(".pdf") and entry.is_file(follow_symlinks=False):
+                handler.on_created(FileCreatedEvent(entry.path))
+    logger.info(f"📁 Monitoring folder: {input_dir}")
 
+    last_optimize = time.monotonic()
     try:
         while True:
             time.sleep(1)
+            if time.monotonic() - last_optimize >= DB_OPTIMIZE_INTERVAL:
+                try:
+                    optimize()
+                except Exception as e:
+                    logger.warning(f"DB optimize (ANALYZE) failed: {e}")
+                last_optimize = time.monotonic()
     except KeyboardInterrupt:
         import sys
-        print("🛑 Stopping monitor...")
+        logger.info("🛑 Stopping monitor...")
         observer.stop()
         # observer.join()
-        print("✅ Folder monitor exited cleanly.")
+        logger.info("✅ Folder monitor exited cleanly.")
         sys.exit(0)
 
 if __name__ == "__main__":
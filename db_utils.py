@@ -7,26 +7,29 @@ from __future__ import annotations
 
 import sqlite3
 from datetime import datetime
+from itertools import repeat
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Iterable, List, Tuple
 
 __all__ = [
     "init_schema",
     "receipt_exists",
     "insert_success_receipt",
+    "insert_many_success",
     "insert_failed_receipt",
+    "optimize",
 ]
 
-DB_PATH = Path(__file__).with_name("receipts.db")
+DB_PATH = str(Path(__file__).with_name("receipts.db"))  # str: no __fspath__ per connect
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Connection helper ─ a **context‑manager** that always closes the handle.
 # ----------------------------------------------------------------------------
 
 def _connect():
-    """Return a connection with WAL mode enabled for concurrency."""
+    """Return an autocommit connection (WAL itself is persisted by ``init_schema``)."""
     conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)  # autocommit
-    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")  # per-connection, not stored in the file
     return conn
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -39,6 +42,9 @@ def init_schema() -> None:
         cur = conn.cursor()
         cur.executescript(
             """
+            -- persisted in the file; the other pragmas are per connection (see _connect)
+            PRAGMA journal_mode = WAL;
+
             CREATE TABLE IF NOT EXISTS successful_receipts (
                 generated_receipt_id TEXT PRIMARY KEY,
                 original_pdf_filename TEXT NOT NULL,
@@ -77,30 +83,116 @@ def init_schema() -> None:
                 evaluation_score INTEGER,
                 processed_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             );
+
+            -- receipt_exists() looks receipts up by their original filename
+            CREATE INDEX IF NOT EXISTS idx_succ_pdf_filename
+                ON successful_receipts (original_pdf_filename);
+
+            -- per‑day sequence for generated_receipt_id (shared by both tables)
+            CREATE TABLE IF NOT EXISTS id_counters (
+                date TEXT PRIMARY KEY,
+                n INTEGER NOT NULL
+            );
+
+            -- bring counters up to date with IDs issued before the table existed
+            INSERT INTO id_counters (date, n)
+                SELECT substr(generated_receipt_id, 1, 6),
+                       MAX(CAST(substr(generated_receipt_id, 8) AS INTEGER))
+                FROM (SELECT generated_receipt_id FROM successful_receipts
+                      UNION ALL
+                      SELECT generated_receipt_id FROM failed_receipts)
+                WHERE generated_receipt_id GLOB '[0-9][0-9][0-9][0-9][0-9][0-9]_*'
+                GROUP BY 1
+            ON CONFLICT(date) DO UPDATE SET n = max(n, excluded.n);
             """
         )
 
 # Call once at import time so that other helpers can assume the schema exists.
 init_schema()
 
+
+def optimize() -> None:
+    """Refresh the query‑planner statistics (cheap; meant to run periodically).
+    ``PRAGMA optimize`` would be a no‑op here – it only looks at tables the same
+    connection has queried – so run a sampled ANALYZE instead."""
+    with _connect() as conn:
+        conn.executescript("PRAGMA analysis_limit = 400; ANALYZE;")
+
 # ──────────────────────────────────────────────────────────────────────────────
 # ID helper
 # ----------------------------------------------------------------------------
 
-def _next_receipt_id(cur: sqlite3.Cursor, date_yymmdd: str, table: str) -> str:
+def _next_receipt_id(cur: sqlite3.Cursor, date_yymmdd: str) -> str:
+    """Atomically bump the day's counter and return ``YYMMDD_NNN``."""
     cur.execute(
-        f"""SELECT generated_receipt_id FROM {table}
-            WHERE generated_receipt_id LIKE ? ORDER BY 1 DESC LIMIT 1""",
-        (f"{date_yymmdd}_%",),
+        """INSERT INTO id_counters (date, n) VALUES (?, 1)
+           ON CONFLICT(date) DO UPDATE SET n = n + 1
+           RETURNING n""",
+        (date_yymmdd,),
+    )
+    (n,), = cur.fetchall()  # fetchall() finishes the statement
+    return f"{date_yymmdd}_{n:03d}"
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Insert helpers ─ SQL is built once; the parameter tuple is built per row.
+# ----------------------------------------------------------------------------
+
+_SQL_INSERT_SUCCESS = """INSERT INTO successful_receipts (
+    generated_receipt_id, original_pdf_filename, date, amount, tax, tax_rate,
+    vendor_name, vendor_address, vendor_phone, registration_number, description,
+    category, original_extracted_data, feedback, evaluation_score
+) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+_SQL_INSERT_FAILED = """INSERT INTO failed_receipts (
+    generated_receipt_id, original_pdf_filename, error_message,
+    date, amount, tax, tax_rate,
+    vendor_name, vendor_address, vendor_phone, registration_number, description,
+    category, original_extracted_data, feedback, evaluation_score
+) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+def _receipt_date(extracted: Dict[str, Any]) -> str:
+    """``日付`` (YYYYMMDD) as YYMMDD, falling back to today."""
+    date_raw = extracted.get("日付")
+    try:
+        return datetime.strptime(date_raw, "%Y%m%d").strftime("%y%m%d") if date_raw else datetime.now().strftime("%y%m%d")
+    except Exception:
+        return datetime.now().strftime("%y%m%d")
+
+_EMPTY: Dict[str, Any] = {}                          # shared stand‑in for a missing 相手先
+_AMOUNT_KEYS = ("日付", "金額", "消費税", "消費税率")  # date, amount, tax, tax_rate
+_VENDOR_KEYS = ("名前", "住所", "電話番号")            # vendor_name, vendor_address, vendor_phone
+
+def _success_params(gen_id: str, pdf_name: str, extracted: Dict[str, Any], feedback: str, score: int) -> tuple:
+    vendor = extracted.get("相手先") or _EMPTY
+    return (
+        gen_id,
+        pdf_name,
+        *map(extracted.get, _AMOUNT_KEYS),
+        *map(vendor.get, _VENDOR_KEYS),
+        extracted.get("登録番号"),
+        json_dumps(extracted.get("摘要")),
+        extracted.get("カテゴリ"),
+        json_dumps(extracted),
+        feedback,
+        score,
+    )
+
+def _failed_params(gen_id: str, pdf_name: str, error_msg: str, extracted: Dict[str, Any],
+                   feedback: str | None, score: int | None) -> tuple:
+    vendor = extracted.get("相手先") or _EMPTY
+    return (
+        gen_id,
+        pdf_name,
+        error_msg,
+        *map(extracted.get, _AMOUNT_KEYS, repeat('')),
+        *map(vendor.get, _VENDOR_KEYS, repeat('')),
+        extracted.get("登録番号", ''),
+        json_dumps(extracted.get("摘要", '')),
+        extracted.get("カテゴリ", ''),
+        json_dumps(extracted),
+        feedback,
+        score,
     )
-    last = cur.fetchone()
-    next_counter = 1
-    if last:
-        try:
-            next_counter = int(last[0].split("_")[-1]) + 1
-        except (ValueError, IndexError):
-            pass
-    return f"{date_yymmdd}_{next_counter:03d}"
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Public helpers
@@ -118,78 +210,43 @@ def receipt_exists(pdf_name: str) -> bool:
 
 def insert_success_receipt(pdf_name: str, extracted: Dict[str, Any], feedback: str, score: int) -> str:
     """Insert a successfully processed receipt and return its generated ID."""
-    date_raw = extracted.get("日付")
-    try:
-        date_yymmdd = datetime.strptime(date_raw, "%Y%m%d").strftime("%y%m%d") if date_raw else datetime.now().strftime("%y%m%d")
-    except Exception:
-        date_yymmdd = datetime.now().strftime("%y%m%d")
-
-    with _connect() as conn:
+    date_yymmdd = _receipt_date(extracted)
+    with _connect() as conn:  # the with‑block COMMITs, or ROLLBACKs on error
         cur = conn.cursor()
-        gen_id = _next_receipt_id(cur, date_yymmdd, "successful_receipts")
-        cur.execute(
-            """INSERT INTO successful_receipts (
-                generated_receipt_id, original_pdf_filename, date, amount, tax, tax_rate, 
-                vendor_name, vendor_address, vendor_phone, registration_number, description,
-                category, original_extracted_data, feedback, evaluation_score
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-            (
-                gen_id,
-                pdf_name,
-                extracted.get("日付"),
-                extracted.get("金額"),
-                extracted.get("消費税"),
-                extracted.get("消費税率"),
-                (extracted.get("相手先") or {}).get("名前"),
-                (extracted.get("相手先") or {}).get("住所"),
-                (extracted.get("相手先") or {}).get("電話番号"),
-                extracted.get("登録番号"),
-                json_dumps(extracted.get("摘要")),
-                extracted.get("カテゴリ"),
-                json_dumps(extracted, ensure_ascii=False),
-                feedback,
-                score,
-            ),
-        )
+        cur.execute("BEGIN IMMEDIATE")  # counter bump + insert = one WAL commit
+        gen_id = _next_receipt_id(cur, date_yymmdd)
+        cur.execute(_SQL_INSERT_SUCCESS, _success_params(gen_id, pdf_name, extracted, feedback, score))
         return gen_id
 
+def insert_many_success(receipts: Iterable[Tuple[str, Dict[str, Any], str, int]]) -> List[str]:
+    """Insert several ``(pdf_name, extracted, feedback, score)`` rows in one
+    transaction and return their generated IDs in the same order."""
+    receipts = list(receipts)
+    if not receipts:
+        return []
+    with _connect() as conn:  # the with‑block COMMITs, or ROLLBACKs on error
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ids, rows = [], []
+        for pdf_name, extracted, feedback, score in receipts:
+            gen_id = _next_receipt_id(cur, _receipt_date(extracted))
+            ids.append(gen_id)
+            rows.append(_success_params(gen_id, pdf_name, extracted, feedback, score))
+        cur.executemany(_SQL_INSERT_SUCCESS, rows)
+    return ids
+
 def insert_failed_receipt(pdf_name: str, error_msg: str, extracted: Dict[str, Any], feedback: str | None, score: int | None) -> str:
-    date_raw = extracted.get("日付")
-    try:
-        date_yymmdd = datetime.strptime(date_raw, "%Y%m%d").strftime("%y%m%d") if date_raw else datetime.now().strftime("%y%m%d")
-    except Exception:
-        date_yymmdd = datetime.now().strftime("%y%m%d")
-    with _connect() as conn:
+    date_yymmdd = _receipt_date(extracted)
+    with _connect() as conn:  # the with‑block COMMITs, or ROLLBACKs on error
         cur = conn.cursor()
-        gen_id = _next_receipt_id(cur, date_yymmdd, "failed_receipts")
-        cur.execute(
-            """INSERT INTO failed_receipts (
-                generated_receipt_id, original_pdf_filename, error_message,
-                date, amount, tax, tax_rate, 
-                vendor_name, vendor_address, vendor_phone, registration_number, description,
-                category, original_extracted_data, feedback, evaluation_score
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-            (
-                gen_id, 
-                pdf_name, 
-                error_msg, 
-                extracted.get("日付", ''),
-                extracted.get("金額", ''),
-                extracted.get("消費税", ''),
-                extracted.get("消費税率", ''),
-                (extracted.get("相手先") or {}).get("名前", ''),
-                (extracted.get("相手先") or {}).get("住所", ''),
-                (extracted.get("相手先") or {}).get("電話番号", ''),
-                extracted.get("登録番号", ''),
-                json_dumps(extracted.get("摘要", '')),
-                extracted.get("カテゴリ", ''),
-                json_dumps(extracted, ensure_ascii=False),
-                feedback, 
-                score
-            ),
-        )
+        cur.execute("BEGIN IMMEDIATE")  # counter bump + insert = one WAL commit
+        gen_id = _next_receipt_id(cur, date_yymmdd)
+        cur.execute(_SQL_INSERT_FAILED, _failed_params(gen_id, pdf_name, error_msg, extracted, feedback, score))
         return gen_id
 
 # local helper because we can’t import json at top (circular in tools)
-import json
-json_dumps = json.dumps
\ No newline at end of file
+import orjson
+
+def json_dumps(obj: Any) -> str:
+    """Serialise with orjson; output is UTF‑8 text, never ASCII‑escaped."""
+    return orjson.dumps(obj).decode()
\ No newline at end of file
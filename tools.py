@@ -1,19 +1,71 @@
 import os
 import fitz
-from PIL import Image, ImageChops
+import numpy as np
+from PIL import Image
 import json
+import re
+import orjson
 import shutil
 from langchain_core.tools import tool
 import google.generativeai as genai
+from google.api_core import exceptions as gexc
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 import time
 
 import io
+import hashlib
+import sqlite3
+from contextlib import closing
 from dotenv import load_dotenv
 import logging
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 import errno
-
-# Set up logging
-logging.basicConfig(filename="info.log", level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s') 
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
+
+# True inside a render‑pool worker. Spawned children re‑import __main__ (and so
+# this module) after multiprocessing has renamed the process, but before
+# parent_process() is set. Workers only rasterise, so they skip the background
+# threads set up below.
+_IN_WORKER = multiprocessing.current_process().name != "MainProcess"
+
+# Set up logging. Callers only enqueue records; a listener thread does the
+# file/console IO, so a multi‑KB Gemini response never blocks a worker on disk.
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+_log_listener: QueueListener | None = None
+
+def start_queue_logging(*handlers: logging.Handler, level: int = logging.INFO) -> None:
+    """Route the root logger through a queue to *handlers* (default: info.log).
+    Calling it again replaces the previous listener, so an entry point can add
+    its own handlers after importing this module. No‑op in render workers."""
+    global _log_listener
+    if _IN_WORKER:
+        return
+    if not handlers:
+        file_handler = logging.FileHandler("info.log", encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers = (file_handler,)
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))  # real formatting happens in the listener
+    if _log_listener is not None:
+        _log_listener.stop()  # flushes what is already queued
+        atexit.unregister(_log_listener.stop)
+        for h in _log_listener.handlers:
+            if h not in handlers:
+                h.close()
+    logging.basicConfig(level=level, handlers=[queue_handler], force=True)
+    _log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+if not logging.getLogger().handlers and not _IN_WORKER:  # leave an application's own logging alone
+    start_queue_logging()
 logger = logging.getLogger(__name__)
 
 load_dotenv()
@@ -25,7 +77,9 @@ if GOOGLE_API_KEY:
 
 
 def _resize_image_for_gemini(image, max_size=2000):
-    """Resizes a PIL Image to a maximum dimension for Gemini's input limits."""
+    """Resizes a PIL Image to a maximum dimension for Gemini's input limits.
+    Bilinear is plenty for a model upload; on large reductions Pillow first
+    box‑reduces by an integer factor (reducing_gap), which is cheap and antialiased."""
     width, height = image.size
     if max(width, height) > max_size:
         if width > height:
@@ -34,20 +88,154 @@ def _resize_image_for_gemini(image, max_size=2000):
         else:
             new_height = max_size
             new_width = int(max_size * width / height)
-        return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        return image.resize((new_width, new_height), Image.Resampling.BILINEAR, reducing_gap=2.0)
     return image
 
 def _pixmap_to_pillow(pix: fitz.Pixmap) -> Image.Image:
-    """Convert a PyMuPDF Pixmap to a Pillow Image safely for any colorspace."""
-    png_bytes: bytes = pix.tobytes("png")          # universal
-    return Image.open(io.BytesIO(png_bytes)).convert("RGB")
+    """Convert a PyMuPDF Pixmap to an RGB Pillow Image for any colorspace,
+    wrapping the raw samples instead of round‑tripping through PNG."""
+    if pix.colorspace and pix.colorspace.n != 3:   # gray / CMYK → RGB
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)                  # drop the alpha channel
+    # pix.samples is an independent bytes copy, so the image outlives the Pixmap
+    return Image.frombuffer("RGB", (pix.width, pix.height), pix.samples, "raw", "RGB", 0, 1)
+
+def _content_bbox(img: Image.Image) -> tuple[int, int, int, int] | None:
+    """Bounding box of the non‑white pixels, in ``Image.getbbox`` convention."""
+    arr = np.asarray(img)
+    # a pixel is background only if every channel is 255, i.e. its minimum is
+    mask = (arr.min(axis=2) if arr.ndim == 3 else arr) < 255
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+PREVIEW_DPI = 72  # at 72 DPI one pixel is one PDF point
+
+def _render_cropped_page(page: fitz.Page, dpi: int, padding: int = 20, max_size: int | None = None) -> Image.Image:
+    """Render only the receipt area of *page* at *dpi*, keeping *padding* pixels.
+    The content box is found on a cheap 72 DPI preview, so the white margins are
+    never rasterised at full resolution. With *max_size* the resolution is lowered
+    so the longer side fits, instead of rendering large and resampling afterwards."""
+    bbox = _content_bbox(_pixmap_to_pillow(page.get_pixmap(dpi=PREVIEW_DPI)))
+    if bbox:
+        pad = padding * PREVIEW_DPI / dpi + 1  # +1 pt for anti‑aliasing in the preview
+        left, upper, right, lower = bbox
+        clip = fitz.Rect(left - pad, upper - pad, right + pad, lower + pad) & page.rect
+    else:
+        clip = page.rect # No content detected, keep full page
+
+    zoom = dpi / PREVIEW_DPI
+    if max_size:
+        # one pixel of slack: MuPDF rounds the pixmap size outwards
+        zoom = min(zoom, (max_size - 1) / max(clip.width, clip.height))
+    return _pixmap_to_pillow(page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip))
+
+JPEG_QUALITY = 90
+
+def _jpeg_part(img: Image.Image) -> dict:
+    """Encode *img* as an inline JPEG blob for ``generate_content``.
+    Much smaller than the PNG the SDK would otherwise encode a PIL image to."""
+    if img.mode not in ("RGB", "L"):  # JPEG has no alpha or palette
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=False)
+    return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+# Up to this many pages are rendered in the calling thread, which saves pickling
+# them back from the pool. PyMuPDF is not thread‑safe, so in‑process fitz work is
+# serialised by _fitz_lock, and only a thread that finds it free renders inline;
+# everything else goes to the process pool, where each worker is single‑threaded.
+INLINE_RENDER_PAGES = 2
+_fitz_lock = threading.Lock()
+
+# One render pool for the life of the process, started on first use, so the
+# worker start‑up (and MuPDF warm‑up) is paid once rather than per PDF.
+RENDER_WORKERS = min(os.cpu_count() or 1, 4)
+_RENDER_POOL: ProcessPoolExecutor | None = None
+# spawn, not fork (or forkserver, whose server would import __main__ with its threads)
+_RENDER_MP_CONTEXT = multiprocessing.get_context("spawn")
+_render_pool_lock = threading.Lock()
+
+def _worker_init() -> None:
+    """Warm a fresh render worker: MuPDF's rasteriser and Pillow's codecs."""
+    with fitz.open() as doc:
+        doc.new_page(width=72, height=72).get_pixmap()
+    Image.init()
+
+def _render_pool() -> ProcessPoolExecutor:
+    global _RENDER_POOL
+    with _render_pool_lock:
+        if _RENDER_POOL is None:
+            # never fork: this process already runs observer, logging and fsync threads;
+            # spawning costs more but is paid once per pool
+            _RENDER_POOL = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=_RENDER_MP_CONTEXT,
+                                               initializer=_worker_init)
+            atexit.register(_RENDER_POOL.shutdown)
+        return _RENDER_POOL
+
+def _reset_render_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool (a worker died) so the next call starts a new one."""
+    global _RENDER_POOL
+    with _render_pool_lock:
+        if _RENDER_POOL is pool:
+            _RENDER_POOL = None
+            atexit.unregister(pool.shutdown)
+    pool.shutdown(wait=False)
+
+def _render_doc_page(doc: fitz.Document, page_num: int, dpi: int, max_size: int, jpeg: bool) -> Image.Image | dict:
+    """Render, crop and size one (1‑based) page of an open *doc* for Gemini."""
+    img = _render_cropped_page(doc[page_num - 1], dpi, max_size=max_size)
+    img = _resize_image_for_gemini(img, max_size=max_size)  # no‑op unless rounding overshot
+    return _jpeg_part(img) if jpeg else img
+
+def _render_page(pdf_data: bytes, page_num: int, dpi: int, max_size: int, jpeg: bool = False) -> Image.Image | dict:
+    """Worker‑process entry point: parse the PDF from the parent's bytes, so the
+    file itself is read only once per receipt."""
+    with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+        return _render_doc_page(doc, page_num, dpi, max_size, jpeg)
+
+def _page_count(pdf_data: bytes) -> int:
+    """Worker‑process entry point: number of pages in the PDF."""
+    with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+        return doc.page_count
+
+def render_receipt_pages(pdf_path: str, dpi: int = 300, max_size: int = 2000, jpeg: bool = False) -> list[Image.Image] | list[dict]:
+    """Render every page of *pdf_path* as a cropped, in‑memory receipt image
+    whose longer side is at most *max_size* (Gemini's input limit).
+    With *jpeg* each page comes back already encoded as a Gemini image part,
+    so the encode happens in the render worker and only bytes are pickled back."""
+    with open(pdf_path, "rb") as f:
+        pdf_data = f.read()  # one read; no file handle stays open while we render
+    page_count = None
+    if _fitz_lock.acquire(blocking=False):
+        try:
+            with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+                page_count = doc.page_count
+                if page_count <= INLINE_RENDER_PAGES:
+                    return [_render_doc_page(doc, n, dpi, max_size, jpeg) for n in range(1, page_count + 1)]
+        finally:
+            _fitz_lock.release()
+    # Rasterising is CPU‑bound and pages are independent. If another thread holds
+    # the lock, don't wait for it: even the page count comes from the pool.
+    render = partial(_render_page, pdf_data, dpi=dpi, max_size=max_size, jpeg=jpeg)
+    pool = _render_pool()
+    try:
+        if page_count is None:
+            page_count = pool.submit(_page_count, pdf_data).result()
+        return list(pool.map(render, range(1, page_count + 1)))
+    except BrokenProcessPool:
+        _reset_render_pool(pool)
+        raise
 
 @tool
 def extract_and_crop_receipt_images(pdf_path: str, cropped_images_folder: str) -> str:
     """
     Extracts images from a PDF, crops the main content area (receipt),
-    and saves cropped images to the output folder.
-    Returns a JSON string of {'pdf_filename': ['path/to/img1.png', 'path/to/img2.png', ...]}
+    and saves them to the output folder as Gemini‑ready JPEGs (≤2000 px).
+    Returns a JSON string of {'pdf_filename': ['path/to/img1.jpg', 'path/to/img2.jpg', ...]}
     or an error message.
     """
     cropped_image_paths = []
@@ -55,37 +243,16 @@ def extract_and_crop_receipt_images(pdf_path: str, cropped_images_folder: str) -
 
     if not os.path.exists(pdf_path):
         return f"ERROR: PDF file not found at {pdf_path}"
-    if not os.path.isdir(cropped_images_folder):
-        os.makedirs(cropped_images_folder, exist_ok=True) # Ensure folder exists
+    os.makedirs(cropped_images_folder, exist_ok=True) # Ensure folder exists (no‑op if it does)
 
     try:
-        doc = fitz.open(pdf_path)
-        for page_num, page in enumerate(doc, start=1):
-            img = _pixmap_to_pillow(page.get_pixmap(dpi=300))
-
-            # Automatic cropping of whitespace with padding
-            bg = Image.new(img.mode, img.size, (255, 255, 255))
-            bbox = ImageChops.difference(img, bg).getbbox()
-
-            if bbox:
-                padding = 20
-                left, upper, right, lower = bbox
-                img_width, img_height = img.size
-
-                left = max(0, left - padding)
-                upper = max(0, upper - padding)
-                right = min(img_width, right + padding)
-                lower = min(img_height, lower + padding)
-
-                cropped_img = img.crop((left, upper, right, lower))
-            else:
-                cropped_img = img # No content detected, keep full page
-
-            output_image_path = os.path.join(cropped_images_folder, f"{base_filename}_page_{page_num}.png")
-            cropped_img.save(output_image_path)
+        for page_num, part in enumerate(render_receipt_pages(pdf_path, jpeg=True), start=1):
+            output_image_path = os.path.join(cropped_images_folder, f"{base_filename}_page_{page_num}.jpg")
+            # Exactly the bytes Gemini gets, so extract_data_from_images can send them as they are.
+            with open(output_image_path, "wb") as f:
+                f.write(part["data"])
             cropped_image_paths.append(output_image_path)
 
-        doc.close()
         if not cropped_image_paths:
              return f"ERROR: No images were extracted from {pdf_path}. It might be empty or corrupted."
 
@@ -94,11 +261,228 @@ def extract_and_crop_receipt_images(pdf_path: str, cropped_images_folder: str) -
         return f"ERROR: Failed to extract and crop images from '{pdf_path}': {e}"
     
 
+_EXTRACTION_PROMPT = """
+        あなたは領収書のデータを抽出し、構造化するエキスパートAIアシスタントです。
+        提供された領収書画像から以下の詳細を抽出してください。領収書は複数のページにわたる場合があります。
+        すべてのページからの情報を単一のJSONオブジェクトに統合してください。フィールドが見つからない場合は「null」を使用します。
+        出力は、JSONオブジェクト以外の余分なテキストやフォーマットを含まない、クリーンなJSONオブジェクトでなければなりません。
+
+        抽出するフィールド:
+        - "宛名" (Addressee): サービス/製品の受取人の名前。
+        - "日付" (Date): 取引の日付。YYYYMMDD形式で指定してください。
+        - "金額" (Amount): 取引の合計金額。数字のみ、カンマや通貨記号なしで返答してください。
+        - "消費税" (Consumption Tax): 取引に関連する消費税額。数字のみ、カンマや通貨記号なしで返答してください。
+        - "消費税率" (Consumption Tax Rate): 適用される消費税率。数字のみ、パーセント記号なしで返答してください。
+        - "相手先" (Vendor): ベンダー情報。辞書形式 { "名前"(Name), "住所" (Address), "電話番号" (Phone Number) }。
+        - "登録番号" (Invoice Registration Number): 日本のインボイス登録番号。
+        - "摘要" (Description): 簡単な説明または品目の詳細。リスト形式 [[名前, 数量, 単価, 合計]]。
+        - カテゴリ (Category): 内容に基づいて、交通費、食費、文具費のいずれかに分類してください。
+
+        さらに 'evaluation_score' (0-100) と 'feedback' フィールドも同じ JSON に含めてください。
+        - "evaluation_score": 抽出結果が正確かつ完全であるという確信度 (0〜100の整数)。
+          必須項目 (日付, 金額, 消費税, 消費税率, 相手先) の有無、形式、金額と明細の整合性、カテゴリの妥当性を考慮してください。
+        - "feedback": 問題点や改善点についての簡潔なフィードバック (日本語)。
+
+        結果を単一の、クリーンなJSONオブジェクトとして出力してください。
+        """
+
+def _extraction_prompt_parts(images: list[Image.Image] | list[dict]) -> list:
+    """Gemini request for the extraction step: instructions followed by the pages
+    (PIL images are sent as JPEG parts)."""
+    return [_EXTRACTION_PROMPT, *(img if isinstance(img, dict) else _jpeg_part(img) for img in images)]
+
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```\s*$", re.DOTALL)
+
+def _strip_json_fence(raw_text: str) -> str:
+    """Drop the ```json ... ``` fence Gemini likes to wrap its answer in."""
+    return _FENCE.sub("", raw_text.strip())
+
+def _json_text(obj) -> str:
+    """Compact UTF‑8 JSON text (orjson never ASCII‑escapes)."""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+def _extraction_result(raw_text: str) -> str:
+    """Turn Gemini's extraction reply into a clean JSON string, or an error message."""
+    cleaned_text = _strip_json_fence(raw_text)
+    try:
+        json_result = orjson.loads(cleaned_text)
+    except orjson.JSONDecodeError as e:
+        return f"ERROR: Gemini output not valid JSON. Raw: {raw_text[:200]}... Error: {e}"
+    return _json_text(json_result) # Return JSON string
+
+# Transient API failures (429 / timeouts / 5xx) are retried with exponential
+# backoff; anything else surfaces immediately as an "ERROR:" result.
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))  # requests per minute across all threads; 0 = unlimited
+_TRANSIENT = (gexc.ResourceExhausted, gexc.DeadlineExceeded, gexc.ServiceUnavailable, gexc.InternalServerError)
+_gemini_retry = retry(
+    retry=retry_if_exception_type(_TRANSIENT),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+
+class _RequestPacer:
+    """Spaces requests evenly so the process stays under *rpm* (a leaky bucket of one)."""
+
+    def __init__(self, rpm: int):
+        self._interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Claim the next slot and return how long the caller must wait for it."""
+        if not self._interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+        return slot - now
+
+_pacer = _RequestPacer(GEMINI_RPM)
+
+@_gemini_retry
+def _call_gemini(model, parts):
+    time.sleep(_pacer.reserve())
+    return model.generate_content(parts)
+
+# Content-addressed cache for extraction replies: identical (model, prompt, pages)
+# requests are answered from disk, so reruns skip the API round trip. Only
+# extraction is cached – the evaluator is always asked afresh – and the controller
+# drops the entry of any receipt that ends up failed, so reprocessing a failed
+# PDF really asks Gemini again. Best effort: cache errors are logged, never fatal.
+# Kept out of receipts.db so cache writes don't wake the UI's change watcher.
+GEMINI_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gemini_cache.db")
+GEMINI_CACHE = os.getenv("GEMINI_CACHE", "1") != "0"
+
+_cache_ready = False
+_cache_init_lock = threading.Lock()
+
+def _cache_connect() -> sqlite3.Connection:
+    """Open the cache; WAL mode and the table are set up once per process."""
+    global _cache_ready
+    conn = sqlite3.connect(GEMINI_CACHE_PATH, timeout=30, isolation_level=None)
+    if not _cache_ready:
+        try:
+            with _cache_init_lock:
+                if not _cache_ready:
+                    conn.execute("PRAGMA journal_mode = WAL;")  # persisted in the file
+                    conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+                    _cache_ready = True
+        except sqlite3.Error:
+            conn.close()
+            raise
+    return conn
+
+def _cache_key(model_name: str, parts) -> str:
+    """SHA‑256 over the model name and every prompt part (text as UTF‑8, image parts as bytes)."""
+    h = hashlib.sha256(model_name.encode())
+    for part in parts if isinstance(parts, list) else [parts]:
+        h.update(b"|")
+        if isinstance(part, dict):
+            h.update(f"{part['mime_type']}:".encode())
+            h.update(part["data"])
+        elif isinstance(part, Image.Image):
+            h.update(f"{part.mode}:{part.size[0]}x{part.size[1]}:".encode())
+            h.update(part.tobytes())
+        else:
+            h.update(str(part).encode())
+    return h.hexdigest()
+
+def _cache_get(key: str) -> str | None:
+    try:
+        with closing(_cache_connect()) as conn:
+            row = conn.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Gemini cache lookup failed, calling the API: {e}")
+        return None
+    return row[0] if row else None
+
+def _cache_put(key: str, text: str) -> None:
+    # only answers that parse are kept, so a malformed reply is retried next time
+    try:
+        orjson.loads(_strip_json_fence(text))
+    except orjson.JSONDecodeError:
+        return
+    try:
+        with closing(_cache_connect()) as conn:
+            conn.execute("PRAGMA synchronous = NORMAL;")  # per connection; only matters for writes
+            conn.execute("INSERT OR REPLACE INTO cache (key, response) VALUES (?, ?)", (key, text))
+    except sqlite3.Error as e:
+        logger.warning(f"Gemini cache store failed (reply kept): {e}")
+
+def _cache_delete(key: str) -> None:
+    try:
+        with closing(_cache_connect()) as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+    except sqlite3.Error as e:
+        logger.warning(f"Gemini cache delete failed: {e}")
+
+@lru_cache(maxsize=8)
+def _get_model(model_name: str) -> genai.GenerativeModel:
+    """Shared model handle per name (construction resolves config every time)."""
+    return genai.GenerativeModel(model_name)
+
+def _cached_generate(parts, model_name: str) -> str:
+    """Response text for *parts*, from the cache when this exact request was seen before."""
+    if not GEMINI_CACHE:
+        return _call_gemini(_get_model(model_name), parts).text
+    key = _cache_key(model_name, parts)
+    text = _cache_get(key)
+    if text is None:
+        text = _call_gemini(_get_model(model_name), parts).text
+        _cache_put(key, text)
+    return text
+
+def extract_receipt_data(images: list[Image.Image] | list[dict], model_name: str = "gemini-2.0-flash") -> str:
+    """
+    Extracts structured data from in‑memory receipt pages using the Gemini API.
+    Pages are PIL images or JPEG parts and must already fit Gemini's limits
+    (as returned by render_receipt_pages).
+    Returns a JSON string of the extracted receipt data (including the model's
+    own 'evaluation_score' and 'feedback'), or an error message.
+    """
+    if not images:
+        return "ERROR: No valid images were successfully loaded for extraction."
+    try:
+        text = _cached_generate(_extraction_prompt_parts(images), model_name)
+        logger.info(text)
+        return _extraction_result(text)
+    except Exception as e:
+        return f"ERROR: Failed to extract data from images: {e}"
+
+def forget_cached_extraction(images: list[Image.Image] | list[dict], model_name: str = "gemini-2.0-flash") -> None:
+    """Drop the cached extraction reply for these pages (same arguments as
+    :func:`extract_receipt_data`), so the next attempt asks Gemini again."""
+    if GEMINI_CACHE and images:
+        _cache_delete(_cache_key(model_name, _extraction_prompt_parts(images)))
+
+
+def _existing_files(paths: list[str]) -> set[str]:
+    """Subset of *paths* that are regular files, listing each parent directory
+    once instead of stat‑ing every path."""
+    by_dir: dict[str, dict[str, list[str]]] = {}
+    for path in paths:
+        folder, name = os.path.split(path)
+        by_dir.setdefault(folder, {}).setdefault(name, []).append(path)
+    present = set()
+    for folder, wanted in by_dir.items():
+        try:
+            with os.scandir(folder or ".") as it:
+                for entry in it:
+                    if entry.name in wanted and entry.is_file():
+                        present.update(wanted[entry.name])
+        except OSError:
+            pass # missing/unreadable folder: none of its files exist
+    return present
+
 @tool
 def extract_data_from_images(image_paths_json_str: str, model_name: str = "gemini-2.0-flash") -> str:
     """
     Extracts structured data from a list of receipt image paths using the Gemini API.
-    Input must be a JSON string like '["path/to/img1.png", "path/to/img2.png"]'.
+    Input must be a JSON string like '["path/to/img1.jpg", "path/to/img2.jpg"]'.
+    JPEGs that already fit Gemini's limits are uploaded as they are; anything
+    else (e.g. older PNG pages) is decoded and resized first.
     Returns a JSON string of the extracted receipt data, or an error message.
     """
     try:
@@ -106,83 +490,33 @@ def extract_data_from_images(image_paths_json_str: str, model_name: str = "gemin
         if not isinstance(image_paths, list):
             return "ERROR: Input image_paths_json_str must be a JSON list of strings."
 
-        model = genai.GenerativeModel(model_name)
-        prompt_parts = [
-            """
-            あなたは領収書のデータを抽出し、構造化するエキスパートAIアシスタントです。
-            提供された領収書画像から以下の詳細を抽出してください。領収書は複数のページにわたる場合があります。
-            すべてのページからの情報を単一のJSONオブジェクトに統合してください。フィールドが見つからない場合は「null」を使用します。
-            出力は、JSONオブジェクト以外の余分なテキストやフォーマットを含まない、クリーンなJSONオブジェクトでなければなりません。
-
-            抽出するフィールド:
-            - "宛名" (Addressee): サービス/製品の受取人の名前。
-            - "日付" (Date): 取引の日付。YYYYMMDD形式で指定してください。
-            - "金額" (Amount): 取引の合計金額。数字のみ、カンマや通貨記号なしで返答してください。
-            - "消費税" (Consumption Tax): 取引に関連する消費税額。数字のみ、カンマや通貨記号なしで返答してください。
-            - "消費税率" (Consumption Tax Rate): 適用される消費税率。数字のみ、パーセント記号なしで返答してください。
-            - "相手先" (Vendor): ベンダー情報。辞書形式 { "名前"(Name), "住所" (Address), "電話番号" (Phone Number) }。
-            - "登録番号" (Invoice Registration Number): 日本のインボイス登録番号。
-            - "摘要" (Description): 簡単な説明または品目の詳細。リスト形式 [[名前, 数量, 単価, 合計]]。
-            - カテゴリ (Category): 内容に基づいて、交通費、食費、文具費のいずれかに分類してください。
-
-            結果を単一の、クリーンなJSONオブジェクトとして出力してください。
-            """
-        ]
-
-        image_parts = []
+        images = []
+        present = _existing_files(image_paths)
         for path in image_paths:
-            if not os.path.exists(path):
+            if path not in present:
                 logger.info(f"Warning: Image file not found at {path}. Skipping.")
                 continue
             try:
-                img = Image.open(path)
-                resized_img = _resize_image_for_gemini(img) # Use internal helper
-                image_parts.append(resized_img)
+                with open(path, "rb") as f:
+                    data = f.read()
+                img = Image.open(io.BytesIO(data))  # lazy: only the header is parsed here
+                if img.format == "JPEG" and max(img.size) <= 2000:
+                    images.append({"mime_type": "image/jpeg", "data": data})
+                else:
+                    images.append(_resize_image_for_gemini(img)) # files may come from anywhere
             except Exception as e:
                 return f"ERROR: Could not load or resize image {path}. Error: {e}"
-
-        if not image_parts:
-            return "ERROR: No valid images were successfully loaded for extraction."
-
-        prompt_parts.extend(image_parts)
-        response = model.generate_content(prompt_parts)
-        logger.info(response.text)
-        raw_text = response.text
-
-        if raw_text.startswith("```json"):
-            cleaned_text = raw_text.replace("```json", "", 1).strip()
-            if cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[:-3].strip()
-        else:
-            cleaned_text = raw_text.strip()
-
-        json_result = json.loads(cleaned_text)
-        return json.dumps(json_result, ensure_ascii=False) # Return JSON string
-    except json.JSONDecodeError as e:
-        return f"ERROR: Gemini output not valid JSON. Raw: {raw_text[:200]}... Error: {e}"
     except Exception as e:
         return f"ERROR: Failed to extract data from images ({image_paths_json_str}): {e}"
+    return extract_receipt_data(images, model_name)
 
 
-@tool
-def evaluate_extracted_data_with_llm(extracted_json_str: str, original_pdf_path: str, model_name: str = "gemini-2.5-flash") -> str:
-    """
-    Evaluates the quality of extracted receipt data using an LLM and provides a confidence percentage.
-    Input is the extracted JSON string and the original PDF path (for context).
-    Returns a JSON string containing {'evaluation_score': int, 'feedback': str} or an error message.
-    """
-    try:
-        extracted_data = json.loads(extracted_json_str)
-    except json.JSONDecodeError:
-        return "ERROR: Input extracted_json_str is not a valid JSON string for evaluation."
-    model = genai.GenerativeModel(model_name)
-    # Construct a prompt for the LLM to evaluate the extracted data
-    prompt = f"""
+_EVAL_PROMPT_TMPL = """
     You are an expert AI assistant tasked with evaluating the accuracy and completeness
     of structured data extracted from a receipt.
 
     Here is the extracted data in JSON format:
-    {json.dumps(extracted_data, ensure_ascii=False, indent=2)}
+    {extracted_json}
 
     Please evaluate this extracted data based on the following criteria:
     1.  **Completeness**: Are all expected fields (日付, 金額, 消費税, 消費税率, 相手先) present?
@@ -200,10 +534,22 @@ def evaluate_extracted_data_with_llm(extracted_json_str: str, original_pdf_path:
     - "feedback": (string) Your textual feedback in Japanese.
     """
 
+@tool
+def evaluate_extracted_data_with_llm(extracted_json_str: str, original_pdf_path: str, model_name: str = "gemini-2.5-flash") -> str:
+    """
+    Evaluates the quality of extracted receipt data using an LLM and provides a confidence percentage.
+    Input is the extracted JSON string and the original PDF path (for context).
+    Returns a JSON string containing {'evaluation_score': int, 'feedback': str} or an error message.
+    """
+    try:
+        extracted_data = json.loads(extracted_json_str)
+    except json.JSONDecodeError:
+        return "ERROR: Input extracted_json_str is not a valid JSON string for evaluation."
+    # Construct a prompt for the LLM to evaluate the extracted data
+    prompt = _EVAL_PROMPT_TMPL.format(extracted_json=json.dumps(extracted_data, ensure_ascii=False, indent=2))
+
     try:
-        response = model.generate_content(prompt)
-        # logger.info(response)
-        raw_text = response.text.strip()
+        raw_text = _call_gemini(_get_model(model_name), prompt).text.strip()  # never cached
 
         # --- Added debugging logger.info and error handling ---
         # logger.info(f"--- Raw LLM Response ---:\n{raw_text}\n--- End Raw LLM Response ---")
@@ -211,14 +557,8 @@ def evaluate_extracted_data_with_llm(extracted_json_str: str, original_pdf_path:
         if not raw_text:
              return "ERROR: LLM returned an empty response."
 
-        if raw_text.startswith("```json"):
-            cleaned_text = raw_text.replace("```json", "", 1).strip()
-            if cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[:-3].strip()
-        else:
-            cleaned_text = raw_text.strip()
-
-        evaluation_result = json.loads(cleaned_text)
+        cleaned_text = _strip_json_fence(raw_text)
+        evaluation_result = orjson.loads(cleaned_text)
         # logger.info(evaluation_result)
         # --- End Added debugging logger.info and error handling ---
 
@@ -228,50 +568,99 @@ def evaluate_extracted_data_with_llm(extracted_json_str: str, original_pdf_path:
         if not isinstance(evaluation_result["evaluation_score"], int) or not (0 <= evaluation_result["evaluation_score"] <= 100):
             return f"ERROR: LLM evaluation score is not a valid integer between 0 and 100. Raw: {cleaned_text}"
 
-        return json.dumps(evaluation_result, ensure_ascii=False)
-    except json.JSONDecodeError as e:
+        return _json_text(evaluation_result)
+    except orjson.JSONDecodeError as e:
         return f"ERROR: LLM evaluation output not valid JSON. Raw: {raw_text[:200]}... Error: {e}"
     except Exception as e:
         return f"ERROR: Failed to evaluate data with LLM for '{os.path.basename(original_pdf_path)}': {e}"
 
 def generate_unique_receipt_id(cursor_obj, date_str_yymmdd, table_name):
-    """Generates a unique YYMMDD_XXX receipt ID."""
+    """Generates a unique YYMMDD_XXX receipt ID.
+    Uses the per‑day ``id_counters`` table from db_utils.init_schema, which is
+    shared by both receipt tables, so *table_name* is informational only."""
+    from db_utils import _next_receipt_id  # here: importing db_utils initialises the database
     logger.info(f"Generating unique receipt ID for date {date_str_yymmdd} in table {table_name}")
-    base_id = date_str_yymmdd
-    cursor_obj.execute(f"SELECT generated_receipt_id FROM {table_name} WHERE generated_receipt_id LIKE '{base_id}_%' ORDER BY generated_receipt_id DESC LIMIT 1")
-    last_id = cursor_obj.fetchone()
+    return _next_receipt_id(cursor_obj, date_str_yymmdd)
 
-    if last_id:
-        last_counter_str = last_id[0].split('_')[-1]
-        try:
-            last_counter = int(last_counter_str)
-            next_counter = last_counter + 1
-        except ValueError:
-            # Fallback if parsing fails, start from 1
-            next_counter = 1
-    else:
-        next_counter = 1
 
-    return f"{base_id}_{next_counter:03d}"
 
+# Renames become durable once their parent directories are fsync'ed. That is
+# batched on a background thread so the pipeline never waits for it (POSIX only;
+# Windows has no directory handles to fsync; render workers never move files).
+_DIR_FSYNC = hasattr(os, "O_DIRECTORY") and not _IN_WORKER
+DIR_FSYNC_INTERVAL = 0.25
+_dir_fsync_queue: "queue.Queue[str]" = queue.Queue()
 
+def _dir_fsync_worker():
+    while True:
+        dirs = {_dir_fsync_queue.get()}
+        time.sleep(DIR_FSYNC_INTERVAL)
+        while True:
+            try:
+                dirs.add(_dir_fsync_queue.get_nowait())
+            except queue.Empty:
+                break
+        for d in dirs:
+            try:
+                fd = os.open(d, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logger.warning(f"fsync of directory {d} failed: {e}")
+
+if _DIR_FSYNC:
+    threading.Thread(target=_dir_fsync_worker, name="dir-fsync", daemon=True).start()
+
+def _schedule_dir_fsync(src: str, dst: str) -> None:
+    """Queue the directories touched by a ``src`` → ``dst`` move for fsync."""
+    if _DIR_FSYNC:
+        _dir_fsync_queue.put(os.path.dirname(os.path.abspath(src)))
+        _dir_fsync_queue.put(os.path.dirname(os.path.abspath(dst)))
 
 def _robust_move(src: str, dst: str, attempts: int = 5, delay: float = 0.5):
     for i in range(attempts):
         try:
-            return shutil.move(src, dst)
+            try:
+                os.replace(src, dst)  # one atomic rename on the same filesystem
+                moved = dst
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                moved = shutil.move(src, dst)  # other filesystem: copy + unlink
+            _schedule_dir_fsync(src, dst)
+            return moved
         except OSError as e:
             if e.errno == errno.EACCES and i < attempts - 1:
                 time.sleep(delay)
                 continue
             raise
+
+def _remove_tree(path: str) -> None:
+    """Delete *path* and everything below it (a missing *path* is fine).
+    Uses the type scandir already reports instead of stat‑ing every entry."""
+    try:
+        it = os.scandir(path)
+    except FileNotFoundError:
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _remove_tree(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
+
 @tool
-def manage_processed_receipt_files(original_pdf_path:str, cropped_images_folder: str,
+def manage_processed_receipt_files(original_pdf_path:str,
                                    success_pdf_folder: str, error_pdf_folder: str,
-                                   validation_success: bool, new_file_name: str) -> str:
+                                   validation_success: bool, new_file_name: str,
+                                   cropped_images_folder: str = "") -> str:
     """
     Renames the original PDF file based on extracted data, copies it to the output folder,
-    and updates a master JSON log file.
+    and updates a master JSON log file. cropped_images_folder (only used when pages were
+    saved with extract_and_crop_receipt_images) is deleted afterwards.
     Input must include original_pdf_path and the extracted data as a JSON string.
     Returns 'SUCCESS:[new_filename]' or 'ERROR:[description]'.
     """
@@ -279,8 +668,8 @@ def manage_processed_receipt_files(original_pdf_path:str, cropped_images_folder:
         dst_folder = success_pdf_folder if validation_success else error_pdf_folder
         dst_path = os.path.join(dst_folder, f"{new_file_name}.pdf")
         _robust_move(original_pdf_path, dst_path)
-        if os.path.exists(cropped_images_folder):
-            shutil.rmtree(cropped_images_folder)
+        if cropped_images_folder:
+            _remove_tree(cropped_images_folder)
         return f"SUCCESS: moved to {dst_path}"
     except Exception as exc:
         return f"ERROR: {exc}"